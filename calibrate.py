@@ -3,58 +3,88 @@ import pandas as pd
 import numpy as np
 from scipy.optimize import minimize
 import json
-from physics_sim import simulate_hour
+from physics_sim import calibration_loss_nb, BASE_FLOW, BASE_HEAD, BASE_FREQ
 from config import PROCESSED_DATA_PATH, CALIBRATION_FILE_PATH
 
-def calibration_loss(x, df):
+def load_historical_data(path=PROCESSED_DATA_PATH, n_sample=None, df=None):
+    """
+    讀取處理後的歷史數據，並一次取出校準需要的欄位陣列。
+    回傳 (freqs (n, 3), inlet (n,), Q_real (n,))，
+    誤差函數直接使用這些陣列，不需每次呼叫都從 DataFrame 逐列取值。
+    若已傳入 df 則直接使用，不再讀檔。
+    
+    預設使用全部數據 (full batch)；指定 n_sample 時隨機抽樣 (固定 random_state) 部分數據。
+    """
+    if df is None:
+        df = pd.read_csv(path)
+    
+    if n_sample is not None:
+        df = df.sample(n=min(len(df), n_sample), random_state=42)
+    
+    # 複製成可寫入的 C 連續陣列 (pandas 可能回傳唯讀陣列)，與 physics_sim._warmup 編譯的型別一致
+    freqs = np.array(df[['f1', 'f2', 'f3']].to_numpy(dtype=float), order='C')
+    inlet = np.array(df['Inlet_Level'].to_numpy(dtype=float))
+    Q_real = np.array(df['Q_total_m3s'].to_numpy(dtype=float))
+    return freqs, inlet, Q_real
+
+# 前向差分的步長 (相對於參數大小)，與 scipy 預設相同
+FD_STEP = np.sqrt(np.finfo(float).eps)
+
+def calibration_loss(x, freqs, inlet, Q_real):
     """
     誤差函數：計算「模擬結果」與「歷史數據」的差距。
     Minimize 會不斷調整 x 來讓這個回傳值變小。
+    
+    freqs (n, 3)、inlet (n,)、Q_real (n,) 為 load_historical_data 事先取出的陣列，
+    實際計算在 physics_sim.calibration_loss_nb 中平行完成。
+    x 也可以是 (m, 8) 的多組參數，此時 m 組一起計算並回傳 (m,) 的誤差陣列。
     """
+    X = np.atleast_2d(np.asarray(x, dtype=float))
+    
     # 解析未知數向量 x
-    L_out = x[0]      # 未知數 1: 固定的出水口高程
-    k = x[1]          # 未知數 2: 系統管損係數
+    # [L_out, k,  p1_dH, p1_dQ, p2_dH, p2_dQ, p3_dH, p3_dQ]
+    L_out = np.ascontiguousarray(X[:, 0])  # 未知數 1: 固定的出水口高程
+    k = np.ascontiguousarray(X[:, 1])      # 未知數 2: 系統管損係數
+    dH = np.ascontiguousarray(X[:, 2::2])  # 各泵揚程衰退因子
+    dQ = np.ascontiguousarray(X[:, 3::2])  # 各泵流量衰退因子
     
-    # 封裝衰退因子
-    factors = {
-        'pump1_dH': x[2], 'pump1_dQ': x[3],
-        'pump2_dH': x[4], 'pump2_dQ': x[5],
-        'pump3_dH': x[6], 'pump3_dQ': x[7]
-    }
+    # 這裡我們專注於讓 "模擬總流量" 逼近 "真實總流量 (CMS)"
+    total_error = calibration_loss_nb(freqs, inlet, Q_real, L_out, k, dH, dQ,
+                                      BASE_FLOW, BASE_HEAD, BASE_FREQ)
     
-    total_error = 0.0
+    return float(total_error[0]) if np.ndim(x) == 1 else total_error
+
+def calibration_loss_and_grad(x, freqs, inlet, Q_real, bounds):
+    """
+    同時回傳誤差值與梯度 (前向差分)，供 minimize(..., jac=True) 使用。
     
-    # 為了加速校準，我們不跑全部數據，隨機抽樣 100 筆
-    sample_df = df.sample(n=min(len(df), 100), random_state=42)
+    x 與 8 個擾動點組成 (9, 8) 的參數矩陣，一次呼叫算出全部誤差，
+    取代 L-BFGS-B 自行差分時逐一呼叫 9 次誤差函數。
+    擾動後會超出上界的參數改往反方向差分。
+    """
+    x = np.asarray(x, dtype=float)
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+    h = FD_STEP * np.maximum(1.0, np.abs(x))
+    h = np.where(x + h > upper, -h, h)
     
-    for _, row in sample_df.iterrows():
-        freqs = [row['f1'], row['f2'], row['f3']]
-        inlet = row['Inlet_Level']
-        
-        # 1. 計算當下的靜揚程 (未知 L_out - 已知 Inlet)
-        H_stat = L_out - inlet
-        
-        # 2. 跑模擬
-        H_sim, Q_sim, _ = simulate_hour(freqs, H_stat, factors, k)
-        
-        # 3. 計算誤差
-        #    這裡我們專注於讓 "模擬總流量" 逼近 "真實總流量 (CMS)"
-        Q_real = row['Q_total_m3s']
-        
-        if Q_real > 0:
-            # 使用相對誤差平方 ((Sim - Real) / Real)^2
-            err_Q = ((Q_sim - Q_real) / Q_real) ** 2
-            total_error += err_Q
-
-    return total_error
+    losses = calibration_loss(np.vstack([x, x + np.diag(h)]), freqs, inlet, Q_real)
+    grad = (losses[1:] - losses[0]) / h
+    return float(losses[0]), grad
 
-if __name__ == "__main__":
+def main(df=None):
+    """
+    執行系統校準並儲存結果，回傳校準參數字典 (找不到資料時回傳 None)。
+    df 為已處理好的歷史數據 (例如 main.py 由 process_data 直接傳入)，未提供時從檔案讀取。
+    """
     print("開始系統校準...")
     try:
-        df = pd.read_csv(PROCESSED_DATA_PATH)
+        if df is None:
+            df = pd.read_csv(PROCESSED_DATA_PATH)
     except FileNotFoundError:
         print("錯誤：找不到資料。請先執行 process_data.py")
-        exit()
+        return None
+    sample_data = load_historical_data(df=df, n_sample=100)
+    full_data = load_historical_data(df=df)
     
     # --- 設定初始猜測值 (Initial Guess) ---
     # [L_out, k,  p1_dH, p1_dQ, p2_dH, p2_dQ, p3_dH, p3_dQ]
@@ -72,7 +102,15 @@ if __name__ == "__main__":
     
     print("正在最佳化參數 (這可能需要幾分鐘)...")
     # 使用 L-BFGS-B 演算法進行數值最佳化
-    res = minimize(calibration_loss, x0, args=(df,), bounds=bnds, method='L-BFGS-B')
+    # 誤差與梯度由 calibration_loss_and_grad 一次批次算出 (jac=True)
+    # 1) 先以抽樣 100 筆快速找到大致的參數：
+    #    全部數據直接從 x0 出發時，實測會停在明顯較差的局部解 (L_out 卡在下界)
+    res = minimize(calibration_loss_and_grad, x0, args=(*sample_data, bnds),
+                   jac=True, bounds=bnds, method='L-BFGS-B')
+    # 2) 再以全部數據從抽樣結果繼續最佳化，避免結果只擬合到抽樣的那 100 筆
+    print(f"抽樣校準完成 ({res.nit} 次迭代)，改用全部 {len(full_data[0])} 筆數據精修...")
+    res = minimize(calibration_loss_and_grad, res.x, args=(*full_data, bnds),
+                   jac=True, bounds=bnds, method='L-BFGS-B')
     
     print("\n校準完成!")
     print(f"成功狀態: {res.success}")
@@ -88,7 +126,10 @@ if __name__ == "__main__":
         'pump3_dH': res.x[6], 'pump3_dQ': res.x[7]
     }
     
-    import json
     with open(CALIBRATION_FILE_PATH, 'w') as f:
         json.dump(result_dict, f, indent=4)
-    print(f"校準參數已儲存至 {CALIBRATION_FILE_PATH}")
\ No newline at end of file
+    print(f"校準參數已儲存至 {CALIBRATION_FILE_PATH}")
+    return result_dict
+
+if __name__ == "__main__":
+    main()
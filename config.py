@@ -11,6 +11,13 @@ CALIBRATION_FILE_PATH = 'data/calibration_results.json' # 校準結果
 # 邏輯：演算法如果選出 0 < f < 30，我們強制視為 0 (停機)。
 MIN_ON_FREQUENCY = 30.0 
 
+def apply_min_on_frequency(freqs):
+    """
+    套用起停限制：低於 MIN_ON_FREQUENCY 的頻率一律視為 0 (停機)。
+    freqs 可為任意形狀的陣列 (例如 (24, 3) 或 (S, 24, 3))，整個陣列一次處理。
+    """
+    return np.where(freqs < MIN_ON_FREQUENCY, 0.0, freqs)
+
 # 抽水機運轉邊界 (Min, Max)
 # 我們設定 0~60，讓演算法有機會選擇 "0" (停機)
 PUMP_BOUNDS = [
@@ -43,6 +50,13 @@ PUMP_BASE_CURVES = {
     }
 }
 
+# 計算時以揚程反查流量，physics_sim.get_pump_flow 的區間線性搜尋與邊界檢查
+# 都假設揚程遞增 (第 0 點為最大流量、最後一點為關死點)，
+# 因此在這裡一次把所有曲線反轉成 "揚程遞增" 的順序，之後計算時不必每次再反轉
+for _curve in PUMP_BASE_CURVES.values():
+    _curve['flow'] = _curve['flow'][::-1].copy()
+    _curve['head'] = _curve['head'][::-1].copy()
+
 # --- 時段電價設定 (元/度) ---
 def get_tou_price(hour):
     """
@@ -1,27 +1,31 @@
-import os
 import time
+import process_data
+import calibrate
+import optimize
 
-def run_step(script_name):
-    print(f"\n====== 正在執行 {script_name} ======")
-    # 使用 os.system 呼叫 python 執行檔案
-    exit_code = os.system(f"python {script_name}")
+def run_step(step_name, step_func, *args):
+    print(f"\n====== 正在執行 {step_name} ======")
+    # 直接在同一個程序內呼叫各步驟的 main()，
+    # 省去重新啟動 Python 與重新載入模組 (含 Numba 編譯結果) 的時間
+    result = step_func(*args)
     
-    if exit_code != 0:
-        print(f"錯誤：{script_name} 執行失敗！流程終止。")
-        return False
-    return True
+    if result is None:
+        print(f"錯誤：{step_name} 執行失敗！流程終止。")
+    return result
 
 if __name__ == "__main__":
     start_time = time.time()
 
-    # 1. 資料處理
-    if not run_step("process_data.py"): exit()
+    # 1. 資料處理 (處理後的 DataFrame 直接交給校準使用)
+    df = run_step("process_data.py", process_data.main)
+    if df is None: exit()
     
-    # 2. 系統校準
-    if not run_step("calibrate.py"): exit()
+    # 2. 系統校準 (校準結果直接交給最佳化使用)
+    calib = run_step("calibrate.py", calibrate.main, df)
+    if calib is None: exit()
     
     # 3. 最佳化計算
-    if not run_step("optimize.py"): exit()
+    if run_step("optimize.py", optimize.main, calib) is None: exit()
 
     end_time = time.time()
-    print(f"\n====== 全部完成！總耗時: {end_time - start_time:.2f} 秒 ======")
\ No newline at end of file
+    print(f"\n====== 全部完成！總耗時: {end_time - start_time:.2f} 秒 ======")
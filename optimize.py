@@ -2,20 +2,45 @@
 import numpy as np
 from scipy.optimize import differential_evolution
 import json
-from config import MIN_ON_FREQUENCY, PUMP_BOUNDS, get_tou_price
-from physics_sim import simulate_hour
+from functools import lru_cache
+from config import CALIBRATION_FILE_PATH, PUMP_BOUNDS, apply_min_on_frequency, get_tou_price
+from physics_sim import simulate_hours
 
 # --- 1. 載入校準參數 ---
-try:
-    with open('data/calibration_results.json') as f:
-        CALIB = json.load(f)
-    print("成功載入校準參數。")
-except FileNotFoundError:
-    print("錯誤：找不到校準參數。請先執行 calibrate.py")
-    exit()
+# 由 main() 透過 set_calibration 設定 (main.py 也可直接傳入剛算好的校準結果)；
+# 未設定就呼叫目標函數時，會在第一次計算時自動從檔案讀取 (見 _ensure_calibration)
+CALIB = None
+L_OUT = None
+K_VAL = None
+H_STAT_24 = None
 
-L_OUT = CALIB['L_out_const']
-K_VAL = CALIB['system_k']
+def load_calibration(path=CALIBRATION_FILE_PATH):
+    """從檔案讀取校準參數"""
+    with open(path) as f:
+        return json.load(f)
+
+def set_calibration(calib):
+    """設定目標函數使用的校準參數，並重新計算與其相關的常數"""
+    global CALIB, L_OUT, K_VAL, H_STAT_24
+    CALIB = calib
+    L_OUT = calib['L_out_const']
+    K_VAL = calib['system_k']
+    H_STAT_24 = np.array([L_OUT - get_predicted_inlet(h) for h in range(24)])
+    # 參數改變後舊的快取結果不再有效
+    _objective_cached.cache_clear()
+
+def _ensure_calibration():
+    """
+    尚未設定校準參數時 (例如直接 import 本模組，或 spawn 出的 DE 子程序)，
+    從 CALIBRATION_FILE_PATH 讀取並設定；檔案不存在時給出明確的錯誤訊息。
+    """
+    if CALIB is not None:
+        return
+    try:
+        calib = load_calibration()
+    except FileNotFoundError:
+        raise RuntimeError(f"找不到校準參數 {CALIBRATION_FILE_PATH}。請先執行 calibrate.py 或呼叫 set_calibration()") from None
+    set_calibration(calib)
 
 # --- 2. 設定目標與預測 ---
 # 假設：明日需求量 130,000 CMD
@@ -28,53 +53,113 @@ TARGET_CMS_TOTAL = TARGET_CMD # 累積量比較時再轉秒或直接比對體積
 def get_predicted_inlet(h):
     return 6.0 
 
+# 全天 24 小時的電價與靜揚程在最佳化過程中固定不變，先算好一次，
+# 目標函數只需直接使用這兩個陣列 (H_STAT_24 依校準參數在 set_calibration 中計算)
+PRICE_24 = np.array([get_tou_price(h) for h in range(24)])
+
 # --- 3. 定義 DE 的目標函數 ---
+# 目標函數快取 (以量化後的頻率為 key)
+# 實測 maxiter=100、popsize=15 時命中率僅約 0.07% (72 維的候選解量化後幾乎不會重複)，
+# 低於 5% 時快取只會增加量化誤差與 key 計算成本，因此預設關閉
+USE_OBJECTIVE_CACHE = False
+CACHE_FREQ_DECIMALS = 1 # 頻率量化精度：小數點後 1 位 (0.1 Hz)
+
+def simulate_day_vec(freq_matrix, H_stat_24, calib, k):
+    """
+    一次模擬全天 24 小時 (24 個時段的平衡點在同一次 Numba 呼叫內以二分法求出)。
+    
+    輸入:
+      freq_matrix: (24, 3) 每小時三台泵的頻率 (已套用起停限制)，
+                   也可以是 (S, 24, 3) 一次模擬 S 組排程
+      H_stat_24: (24,) 每小時的靜揚程
+      calib: 校準參數字典 (含衰退因子)
+      k: 管損係數
+      
+    輸出:
+      flow_arr, power_arr: (24,) 或 (S, 24) 每小時總流量 (m3/s) 與總功耗 (kW)
+    """
+    freq_matrix = np.asarray(freq_matrix, dtype=float)
+    lead_shape = freq_matrix.shape[:-1]
+    H_stat = np.broadcast_to(H_stat_24, lead_shape)
+    
+    # 所有排程的所有時段攤平成 (S*24, 3) 一起求解
+    _, flow_arr, power_arr = simulate_hours(freq_matrix.reshape(-1, freq_matrix.shape[-1]),
+                                            H_stat.reshape(-1), calib, k)
+    return flow_arr.reshape(lead_shape), power_arr.reshape(lead_shape)
+
 def objective_function(solution_vector):
     """
     DE 演算法會不斷呼叫此函數，傳入一組 72 維的向量 (24小時*3泵)。
     我們需回傳這組解的 "總成本" (越低越好)。
+    
+    開啟 USE_OBJECTIVE_CACHE 時，頻率先量化到 0.1 Hz，相同的排程直接取用快取結果。
+    """
+    if USE_OBJECTIVE_CACHE:
+        key = np.round(solution_vector, CACHE_FREQ_DECIMALS).astype(np.float32).tobytes()
+        return _objective_cached(key)
+    return float(_schedule_costs(solution_vector.reshape((1, 24, 3)))[0])
+
+def objective_vectorized(solutions):
+    """
+    DE (vectorized=True) 使用的目標函數：一次傳入整個族群。
+    solutions 為 (72, S)，每一欄是一組排程，回傳 (S,) 的總成本。
     """
-    # 將一維向量 (72,) 重塑為 (24, 3)
-    freq_matrix = solution_vector.reshape((24, 3))
+    if USE_OBJECTIVE_CACHE:
+        return np.array([objective_function(x) for x in solutions.T])
+    # (72, S) -> (S, 72) -> (S, 24, 3)
+    return _schedule_costs(solutions.T.reshape((-1, 24, 3)))
+
+@lru_cache(maxsize=8192)
+def _objective_cached(freqs_key):
+    """以量化後頻率的 bytes 作為 key 的快取版目標函數"""
+    freq_matrix = np.frombuffer(freqs_key, dtype=np.float32).astype(float).reshape((1, 24, 3))
+    return float(_schedule_costs(freq_matrix)[0])
+
+def _schedule_costs(freq_schedules):
+    """計算 S 組排程 (S, 24, 3) 的總成本 (電費 + 未達標懲罰)，回傳 (S,)"""
+    _ensure_calibration()
     
-    total_cost = 0.0
-    total_flow_accumulated = 0.0 # 累積總抽水量 (m3)
+    # vectorized DE 每一代只呼叫一次 (整輪約 maxiter 次)；逐筆呼叫 objective_function
+    # (非 vectorized 或 workers=-1) 時則每個候選解各呼叫一次，
+    # 因此仍先把模組層級的常數綁成區域變數 (區域變數查找比全域快)
+    on_off = apply_min_on_frequency
+    h_stat, price = H_STAT_24, PRICE_24
+    calib, k_val, target = CALIB, K_VAL, TARGET_CMD
+    sim = simulate_day_vec
     
-    for h in range(24):
-        raw_freqs = freq_matrix[h]
-        
-        # --- 關鍵邏輯：起停限制 (30-60Hz) ---
-        real_freqs = []
-        for f in raw_freqs:
-            if f < MIN_ON_FREQUENCY:
-                real_freqs.append(0.0) # 強制關機
-            else:
-                real_freqs.append(f)   # 保持原設定
-        
-        # 取得該小時預測水位
-        inlet = get_predicted_inlet(h)
-        # 計算靜揚程
-        H_stat = L_OUT - inlet
-        
-        # 執行物理模擬
-        _, q_cms, p_kw = simulate_hour(real_freqs, H_stat, CALIB, K_VAL)
-        
-        # 累加成本 (kW * 1hr * 電價)
-        total_cost += p_kw * get_tou_price(h)
-        
-        # 累加流量 (m3/s * 3600s = m3)
-        total_flow_accumulated += q_cms * 3600
+    # --- 關鍵邏輯：起停限制 (30-60Hz) ---
+    # 低於最低頻率者強制關機
+    freq_schedules = on_off(freq_schedules)
+    
+    # 執行物理模擬 (所有排程的 24 小時一次完成)
+    flow_arr, power_arr = sim(freq_schedules, h_stat, calib, k_val)
+    
+    # 成本 (kW * 1hr * 電價)
+    total_cost = power_arr @ price
+    
+    # 流量 (m3/s * 3600s = m3)
+    total_flow_accumulated = flow_arr.sum(axis=-1) * 3600
         
     # --- 懲罰函數 (Penalty) ---
     # 如果總抽水量未達標，給予巨額罰款
-    penalty = 0.0
-    if total_flow_accumulated < TARGET_CMD:
-        diff = TARGET_CMD - total_flow_accumulated
-        penalty = diff * 1000 # 罰款係數 (可調整)
+    penalty = np.maximum(target - total_flow_accumulated, 0.0) * 1000 # 罰款係數 (可調整)
         
     return total_cost + penalty
 
-if __name__ == "__main__":
+def main(calib=None):
+    """
+    執行 DE 最佳化並印出排程，回傳 DE 結果 (找不到校準參數時回傳 None)。
+    calib 為校準參數字典 (例如 main.py 由 calibrate 直接傳入)，未提供時從檔案讀取。
+    """
+    if calib is None:
+        try:
+            calib = load_calibration()
+        except FileNotFoundError:
+            print("錯誤：找不到校準參數。請先執行 calibrate.py")
+            return None
+        print("成功載入校準參數。")
+    set_calibration(calib)
+    
     print(f"開始最佳化... 目標流量: {TARGET_CMD} CMD")
     print("正在執行差分進化演算法 (DE)...")
     
@@ -84,43 +169,53 @@ if __name__ == "__main__":
     # 執行 DE
     # popsize: 族群大小 (越大越準但越慢)
     # maxiter: 迭代次數
-    # workers: -1 代表用盡所有 CPU 核心加速
+    # vectorized: 每一代把整個族群一次交給 objective_vectorized 批次計算，
+    #             不需逐一呼叫目標函數，也省去多程序 (workers=-1) 的傳輸成本
+    #             (即使改回 workers=-1，目標函數也只以名稱 pickle，每批只傳送候選解向量；
+    #              曲線在 import 時建立。校準參數只有 fork 出的子程序 (Linux) 會從主程序繼承，
+    #              Windows / macOS 以 spawn 啟動的子程序則在第一次計算時由 _ensure_calibration
+    #              從 CALIBRATION_FILE_PATH 重新讀取，因此該檔案必須與傳入 main() 的參數一致；
+    #              兩種情況都不需要另外用 shared_memory 共用陣列)
     res = differential_evolution(
-        objective_function, 
+        objective_vectorized, 
         bounds, 
         strategy='best1bin', 
         maxiter=100, 
         popsize=15, 
-        workers=-1,
+        vectorized=True,
+        updating='deferred',
+        workers=1,
         disp=True
     )
     
+    if USE_OBJECTIVE_CACHE:
+        info = _objective_cached.cache_info()
+        calls = info.hits + info.misses
+        print(f"目標函數快取命中率: {info.hits / calls:.1%} ({info.hits}/{calls})" if calls else "目標函數快取未使用")
+    
     print("\n--- 最佳化結果 ---")
     print(f"最低成本 (含懲罰): {res.fun:.2f}")
     
     # 解析最佳解
     best_schedule = res.x.reshape((24, 3))
     
-    # 重新跑一次模擬以顯示詳細數據
-    print("\n時段 | 泵1(Hz) | 泵2(Hz) | 泵3(Hz) | 流量(CMD) | 功耗(kW) | 電價")
-    total_vol = 0
-    total_bill = 0
+    # 重新跑一次模擬以顯示詳細數據 (24 小時一次模擬，總量直接加總)
+    real_schedule = apply_min_on_frequency(best_schedule)
+    flow_arr, power_arr = simulate_day_vec(real_schedule, H_STAT_24, CALIB, K_VAL)
+    vol_arr = flow_arr * 3600
+    cost_arr = power_arr * PRICE_24
+    total_vol = vol_arr.sum()
+    total_bill = np.dot(power_arr, PRICE_24)
     
+    print("\n時段 | 泵1(Hz) | 泵2(Hz) | 泵3(Hz) | 流量(CMD) | 功耗(kW) | 電價")
     for h in range(24):
-        raw_f = best_schedule[h]
-        real_f = [f if f >= MIN_ON_FREQUENCY else 0.0 for f in raw_f]
-        
-        inlet = get_predicted_inlet(h)
-        H_stat = L_OUT - inlet
-        _, q_cms, p_kw = simulate_hour(real_f, H_stat, CALIB, K_VAL)
-        
-        vol_cmd = q_cms * 3600
-        cost = p_kw * get_tou_price(h)
-        
-        total_vol += vol_cmd
-        total_bill += cost
-        
-        print(f"{h:02d}   | {real_f[0]:5.1f} | {real_f[1]:5.1f} | {real_f[2]:5.1f} | {vol_cmd:8.1f} | {p_kw:6.1f} | {cost:5.1f}")
+        real_f = real_schedule[h]
+        print(f"{h:02d}   | {real_f[0]:5.1f} | {real_f[1]:5.1f} | {real_f[2]:5.1f} | {vol_arr[h]:8.1f} | {power_arr[h]:6.1f} | {cost_arr[h]:5.1f}")
         
     print(f"\n全日總抽水量: {total_vol:.1f} CMD (目標: {TARGET_CMD})")
-    print(f"預估總電費: {total_bill:.1f} 元")
\ No newline at end of file
+    print(f"預估總電費: {total_bill:.1f} 元")
+    
+    return res
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,174 @@
 # physics_sim.py
 import numpy as np
-from scipy.optimize import fsolve
+from numba import njit, prange
 from config import PUMP_BASE_CURVES
 
-def get_pump_flow(pump_id, frequency, head, degradation_factors):
+# 將各泵的原廠曲線預先整理成以泵編號索引的連續陣列 (第 i 列 = 第 i+1 台泵)，
+# 計算時不必再用字串組合 key 查字典，也能一次對所有泵做批次運算
+#   BASE_FLOW: (泵數, N) 流量 (m3/s)
+#   BASE_HEAD: (泵數, N) 揚程 (m)
+#   BASE_FREQ: (泵數,)   原廠基準頻率 (Hz)
+# 曲線在 config.py 中已是揚程遞增的順序，可直接內插
+# 若各泵曲線點數不同，點數不足者以第一點 (最大流量端) 補齊到相同長度 N
+N_PUMPS = len(PUMP_BASE_CURVES)
+
+def _stack_curves(key):
+    curves = [PUMP_BASE_CURVES[f'pump{i+1}'][key] for i in range(N_PUMPS)]
+    n_points = max(len(c) for c in curves)
+    return np.ascontiguousarray(np.stack([
+        np.concatenate((np.repeat(c[0], n_points - len(c)), c)) for c in curves
+    ]), dtype=float)
+
+BASE_FLOW = _stack_curves('flow')
+BASE_HEAD = _stack_curves('head')
+BASE_FREQ = np.array([PUMP_BASE_CURVES[f'pump{i+1}']['freq'] for i in range(N_PUMPS)], dtype=float)
+
+# 平衡點求解 (二分法) 設定：在 [H_static, H_static + HEAD_SEARCH_SPAN] 內搜尋
+BISECTION_ITERS = 30
+HEAD_SEARCH_SPAN = 100.0
+
+@njit(cache=True, fastmath=True)
+def get_pump_flow(base_flow, base_head, base_f, frequency, head, d_H, d_Q):
     """
     計算單台抽水機在給定頻率(f)和揚程(H)下的流量(Q)。
     應用了相似定律 (Affinity Laws) 與老化因子。
+    
+    base_flow / base_head 為原廠曲線陣列，base_f 為原廠基準頻率，
+    d_H / d_Q 為該泵的揚程 / 流量衰退因子 (1.0 代表無衰退)。
     """
     if frequency <= 0.1: # 頻率趨近 0 則視為關機
         return 0.0
     
-    # 1. 取得該泵的衰退因子 (預設為 1.0 無衰退)
+    # 老化縮放與相似定律 (Affinity Laws) 都只是把整條原廠曲線等比例縮放：
     #    dH: 揚程衰退 (曲線上下縮放)
     #    dQ: 流量衰退 (曲線左右縮放)
-    d_H = degradation_factors.get(f'pump{pump_id}_dH', 1.0)
-    d_Q = degradation_factors.get(f'pump{pump_id}_dQ', 1.0)
-    
-    # 2. 讀取原廠 60Hz 曲線
-    curve = PUMP_BASE_CURVES[f'pump{pump_id}']
-    base_f = curve['freq']
-    
-    # 3. 先對原廠曲線進行 "老化縮放"
-    base_H_cal = curve['head'] * d_H
-    base_Q_cal = curve['flow'] * d_Q
-    
-    # 4. 再進行 "相似定律 (Affinity Laws)" 縮放
-    #    Q_new = Q_base * (f_new / f_base)
-    #    H_new = H_base * (f_new / f_base)^2
+    #    Q_new = Q_base * d_Q * (f_new / f_base)
+    #    H_new = H_base * d_H * (f_new / f_base)^2
+    # 因此不需建立整條新曲線，把揚程 H 反推回原廠座標查表，再把查到的流量縮放回來即可
     ratio = frequency / base_f
-    new_Q_curve = base_Q_cal * ratio
-    new_H_curve = base_H_cal * (ratio ** 2)
+    head_base = head / (d_H * ratio * ratio)
+    flow_scale = d_Q * ratio
     
-    # 5. 使用內插法 (Interpolation) 查表
-    #    給定現在的揚程 H (head)，反查能打出多少水 Q
+    # 使用內插法 (Interpolation) 查表
+    # 給定現在的揚程 H (head)，反查能打出多少水 Q
+    n_points = base_head.shape[0]
     
     # 邊界檢查：如果揚程太高 (超過關死點)，流量為 0
-    if head >= new_H_curve[0]: 
+    if head_base >= base_head[n_points - 1]: 
         return 0.0
     # 邊界檢查：如果揚程太低 (低於曲線範圍)，取最大流量
-    if head <= new_H_curve[-1]: 
-        return new_Q_curve[-1]
+    if head_base <= base_head[0]: 
+        return base_flow[0] * flow_scale
     
-    # 內插 (注意：np.interp 需要 x 軸遞增，但 H 通常是遞減，所以用 [::-1] 反轉陣列)
-    predicted_flow = np.interp(head, new_H_curve[::-1], new_Q_curve[::-1])
+    # 內插 (曲線已是揚程遞增的順序)
+    # 曲線只有 6~8 點，直接線性搜尋所在區間，比呼叫 np.interp 的固定成本低
+    for j in range(n_points - 1):
+        if head_base >= base_head[j] and head_base < base_head[j + 1]:
+            t = (head_base - base_head[j]) / (base_head[j + 1] - base_head[j])
+            return (base_flow[j] + t * (base_flow[j + 1] - base_flow[j])) * flow_scale
+    return 0.0
+
+@njit(cache=True, fastmath=True)
+def _hour_residual_nb(H, freqs, static_head, dH_arr, dQ_arr, k, base_flow, base_head, base_freq):
+    """平衡方程式：供給流量 - 需求流量"""
+    # 1. 系統需求曲線 (System Curve)
+    #    Q_sys = sqrt((H - H_static) / K)
+    if H < static_head:
+        q_sys = 0.0
+    else:
+        q_sys = np.sqrt((H - static_head) / k)
     
-    return predicted_flow
+    # 2. 抽水機供給曲線 (Pump Curve)
+    #    Q_pump = Q1 + Q2 + Q3
+    q_pump = 0.0
+    for i in range(freqs.shape[0]):
+        q_pump += get_pump_flow(base_flow[i], base_head[i], base_freq[i],
+                                freqs[i], H, dH_arr[i], dQ_arr[i])
+    return q_pump - q_sys
+
+@njit(cache=True, fastmath=True)
+def _simulate_hour_nb(freqs, static_head, dH_arr, dQ_arr, k, base_flow, base_head, base_freq):
+    """simulate_hour 的 Numba 核心，因子以陣列傳入 (dH_arr[i] 對應第 i+1 台泵)"""
+    # 供給 - 需求 隨 H 單調遞減，且在 H = 靜揚程 時 >= 0，因此以二分法求根
+    lo = static_head
+    hi = static_head + HEAD_SEARCH_SPAN
+    for _ in range(BISECTION_ITERS):
+        mid = 0.5 * (lo + hi)
+        if _hour_residual_nb(mid, freqs, static_head, dH_arr, dQ_arr, k, base_flow, base_head, base_freq) < 0:
+            hi = mid
+        else:
+            lo = mid
+    
+    # 最後以區間兩端做一次線性內插，讓 H_op 隨參數連續變化
+    r_lo = _hour_residual_nb(lo, freqs, static_head, dH_arr, dQ_arr, k, base_flow, base_head, base_freq)
+    r_hi = _hour_residual_nb(hi, freqs, static_head, dH_arr, dQ_arr, k, base_flow, base_head, base_freq)
+    H_op = lo
+    if r_lo - r_hi > 0:
+        H_op = lo + min(max(r_lo / (r_lo - r_hi), 0.0), 1.0) * (hi - lo)
+    
+    # --- 計算結果 ---
+    total_flow = 0.0
+    total_power = 0.0
+    for i in range(freqs.shape[0]):
+        # 再次呼叫函數取得該泵在平衡揚程下的流量
+        q = get_pump_flow(base_flow[i], base_head[i], base_freq[i],
+                          freqs[i], H_op, dH_arr[i], dQ_arr[i])
+        total_flow += q
+        
+        # --- 功耗計算 ---
+        # 這裡使用簡易物理公式 P = (rho * g * Q * H) / efficiency
+        # 如果您有每台泵的 "功率迴歸公式"，請在這裡替換！
+        if q > 0:
+            # 假設綜合效率 (馬達+泵) 為 60% (0.6)
+            # 1 kW = 1000 W
+            # P (kW) = (Q(m3/s) * H(m) * 9810) / (0.6 * 1000)
+            efficiency = 0.6 
+            total_power += (q * H_op * 9.81) / efficiency
+    
+    return H_op, total_flow, total_power
+
+@njit(cache=True, fastmath=True)
+def _simulate_hours_nb(freq_matrix, static_heads, dH_arr, dQ_arr, k, base_flow, base_head, base_freq):
+    """一次模擬多個時段：freq_matrix (n, 3)、static_heads (n,)，回傳三個 (n,) 陣列"""
+    n = freq_matrix.shape[0]
+    H_op = np.empty(n)
+    total_flow = np.empty(n)
+    total_power = np.empty(n)
+    for h in range(n):
+        H_op[h], total_flow[h], total_power[h] = _simulate_hour_nb(
+            freq_matrix[h], static_heads[h], dH_arr, dQ_arr, k, base_flow, base_head, base_freq)
+    return H_op, total_flow, total_power
+
+@njit(parallel=True, fastmath=True, cache=True)
+def calibration_loss_nb(freqs, inlet, Q_real, L_out, k, dH, dQ, base_flow, base_head, base_freq):
+    """
+    calibrate.calibration_loss 的 Numba 核心，各筆歷史資料互相獨立，以 prange 分散到多核心。
+    放在本模組是因為 Numba 的 cache=True 只會檢查函數所在檔案是否變更，
+    若放在其他檔案，修改這裡的 get_pump_flow 後會繼續載入舊的編譯結果。
+    L_out、k 為 (m,)，dH、dQ 為 (m, 泵數)，m 組參數一起計算並回傳 (m,) 的誤差。
+    """
+    m = L_out.shape[0]
+    n = inlet.shape[0]
+    # 每筆資料各自寫入自己的欄位，最後再加總，避免多執行緒同時累加同一個值
+    err = np.zeros((m, n))
+    for i in prange(n):
+        if Q_real[i] > 0:
+            for j in range(m):
+                # 1. 計算當下的靜揚程 (未知 L_out - 已知 Inlet)
+                H_stat = L_out[j] - inlet[i]
+                # 2. 跑模擬
+                _, Q_sim, _ = _simulate_hour_nb(freqs[i], H_stat, dH[j], dQ[j], k[j],
+                                                base_flow, base_head, base_freq)
+                # 3. 使用相對誤差平方 ((Sim - Real) / Real)^2
+                rel_err = (Q_sim - Q_real[i]) / Q_real[i]
+                err[j, i] = rel_err * rel_err
+    return err.sum(axis=1)
+
+def degradation_arrays(factors):
+    """把衰退因子字典轉為 (dH_arr, dQ_arr) 陣列，缺少的項目預設為 1.0 (無衰退)"""
+    dH_arr = np.array([factors.get(f'pump{i+1}_dH', 1.0) for i in range(N_PUMPS)], dtype=float)
+    dQ_arr = np.array([factors.get(f'pump{i+1}_dQ', 1.0) for i in range(N_PUMPS)], dtype=float)
+    return dH_arr, dQ_arr
 
 def simulate_hour(freqs, static_head, factors, system_k):
     """
@@ -62,52 +185,40 @@ def simulate_hour(freqs, static_head, factors, system_k):
       total_flow: 總流量 (m3/s)
       total_power: 總功耗 (kW) - 估算值
     """
-    
-    # 定義平衡方程式：供給流量 - 需求流量 = 0
-    def equations(h_guess):
-        H = h_guess[0]
-        
-        # 1. 系統需求曲線 (System Curve)
-        #    Q_sys = sqrt((H - H_static) / K)
-        if H < static_head:
-            q_sys = 0.0
-        else:
-            q_sys = np.sqrt((H - static_head) / system_k)
-        
-        # 2. 抽水機供給曲線 (Pump Curve)
-        #    Q_pump = Q1 + Q2 + Q3
-        q_pump = 0.0
-        for i in range(3):
-            q_pump += get_pump_flow(i+1, freqs[i], H, factors)
-            
-        return q_pump - q_sys
+    dH_arr, dQ_arr = degradation_arrays(factors)
+    return _simulate_hour_nb(np.asarray(freqs, dtype=float), float(static_head),
+                             dH_arr, dQ_arr, float(system_k), BASE_FLOW, BASE_HEAD, BASE_FREQ)
 
-    # 使用 fsolve 求解平衡揚程
-    # 初始猜測值設為 靜揚程 + 10m
-    try:
-        H_op = fsolve(equations, [static_head + 10.0])[0]
-    except:
-        return 0.0, 0.0, 0.0 # 求解失敗
-        
-    # --- 計算結果 ---
-    total_flow = 0.0
-    total_power = 0.0
+def simulate_hours(freq_matrix, static_heads, factors, system_k):
+    """
+    連續模擬多個時段 (例如全天 24 小時)，整段在 Numba 內完成。
     
-    for i in range(3):
-        f = freqs[i]
-        # 再次呼叫函數取得該泵在平衡揚程下的流量
-        q = get_pump_flow(i+1, f, H_op, factors)
-        total_flow += q
-        
-        # --- 功耗計算 ---
-        # 這裡使用簡易物理公式 P = (rho * g * Q * H) / efficiency
-        # 如果您有每台泵的 "功率迴歸公式"，請在這裡替換！
-        if q > 0:
-            # 假設綜合效率 (馬達+泵) 為 60% (0.6)
-            # 1 kW = 1000 W
-            # P (kW) = (Q(m3/s) * H(m) * 9810) / (0.6 * 1000)
-            efficiency = 0.6 
-            p = (q * H_op * 9.81) / efficiency
-            total_power += p
-            
-    return H_op, total_flow, total_power
\ No newline at end of file
+    輸入:
+      freq_matrix: (n, 3) 每個時段三台泵的頻率
+      static_heads: (n,) 每個時段的靜揚程
+      
+    輸出:
+      H_op, total_flow, total_power: 皆為 (n,) 陣列
+    """
+    dH_arr, dQ_arr = degradation_arrays(factors)
+    # 複製成可寫入的 C 連續陣列：唯讀陣列 (如 broadcast_to 的結果) 在 Numba 中是另一種型別，
+    # 會觸發額外編譯而用不到 _warmup 預先載入的版本
+    return _simulate_hours_nb(np.array(freq_matrix, dtype=float, order='C'),
+                              np.array(static_heads, dtype=float, order='C'),
+                              dH_arr, dQ_arr, float(system_k), BASE_FLOW, BASE_HEAD, BASE_FREQ)
+
+def _warmup():
+    """
+    以假資料呼叫一次所有 Numba 函數，讓編譯 (或從 __pycache__ 載入快取) 在 import 時完成，
+    而不是發生在 DE / 校準的第一次呼叫中。
+    引數型別需與實際呼叫一致 (float64、C 連續陣列)，否則快取不會命中。
+    """
+    freqs = np.zeros((1, N_PUMPS))
+    heads = np.zeros(1)
+    ones = np.ones(N_PUMPS)
+    _simulate_hour_nb(freqs[0], 0.0, ones, ones, 1.0, BASE_FLOW, BASE_HEAD, BASE_FREQ)
+    _simulate_hours_nb(freqs, heads, ones, ones, 1.0, BASE_FLOW, BASE_HEAD, BASE_FREQ)
+    calibration_loss_nb(freqs, heads, heads, heads, np.ones(1), ones[None, :], ones[None, :],
+                        BASE_FLOW, BASE_HEAD, BASE_FREQ)
+
+_warmup()
@@ -62,6 +62,15 @@ def process_data():
     print(f"總筆數: {len(df_out)}")
     print(f"已儲存至: {PROCESSED_DATA_PATH}")
     print(df_out.head())
+    return df_out
+
+def main():
+    """執行資料處理，回傳處理後的 DataFrame (找不到原始檔案時回傳 None)"""
+    try:
+        return process_data()
+    except FileNotFoundError:
+        print(f"錯誤：找不到原始檔案 {RAW_DATA_PATH}")
+        return None
 
 if __name__ == "__main__":
-    process_data()
\ No newline at end of file
+    main()
\ No newline at end of file